@@ -0,0 +1,54 @@
+"""
+Numeric kernels for the map views.
+
+haversine_miles is compiled with numba when it is installed; otherwise the same
+formula runs as NumPy ufuncs.
+"""
+import math
+
+import numpy as np
+from geopy import units
+from geopy.distance import EARTH_RADIUS
+
+try:
+    import numba
+except ImportError:  # optional; the NumPy version below is used instead
+    numba = None
+
+# Mean diameter of the Earth in miles, from the radius geopy's great_circle uses
+EARTH_DIAMETER_MILES = 2 * units.miles(kilometers=EARTH_RADIUS)
+
+
+def _haversine_miles_numpy(lats, lons, clat, clon, out):
+    clat_r, clon_r = math.radians(clat), math.radians(clon)
+    lats_r, lons_r = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats_r - clat_r) / 2) ** 2
+         + math.cos(clat_r) * np.cos(lats_r) * np.sin((lons_r - clon_r) / 2) ** 2)
+    np.multiply(EARTH_DIAMETER_MILES, np.arcsin(np.sqrt(np.minimum(a, 1.0))), out=out)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_miles_numba(lats, lons, clat, clon, out):
+        clat_r = math.radians(clat)
+        clon_r = math.radians(clon)
+        cos_c = math.cos(clat_r)
+        for i in numba.prange(lats.shape[0]):
+            la = math.radians(lats[i])
+            s1 = math.sin((la - clat_r) * 0.5)
+            s2 = math.sin((math.radians(lons[i]) - clon_r) * 0.5)
+            a = min(s1 * s1 + cos_c * math.cos(la) * s2 * s2, 1.0)
+            out[i] = EARTH_DIAMETER_MILES * math.asin(math.sqrt(a))
+
+    _haversine_miles = _haversine_miles_numba
+else:
+    _haversine_miles = _haversine_miles_numpy
+
+
+def haversine_miles(lats, lons, clat, clon):
+    """Haversine distance in miles from (clat, clon) to each point of the float64 lats/lons arrays."""
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    out = np.empty(lats.shape[0], dtype=np.float64)
+    _haversine_miles(lats, lons, float(clat), float(clon), out)
+    return out
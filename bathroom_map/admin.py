@@ -1,22 +1,52 @@
+import codecs
 import csv
+import functools
 import io
 import math
 import os
 import re
+import shutil
 import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, InvalidOperation
 
+from charset_normalizer import from_bytes
 from django import forms
+from django.conf import settings
 from django.contrib import admin, messages
 from django.core.management import call_command
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect, render
 from django.urls import path
-from geopy.geocoders import Nominatim
+import numpy as np
 import shapefile
 
+from .geocode import geocode, geocode_bathroom_later
 from .models import Bathroom
+from .utils import normalize_address
+
+_BOGUS_HOURS_RE = re.compile(r"^[\d\s,.]+$")
+_SHORT_NUM_RE = re.compile(r"^\d+(\.\d+)?$")
+
+_DEC_ZERO = Decimal("0")
+
+# Shapefile attribute names to try, in order, for each Bathroom field
+SHAPEFILE_ATTR_KEYS = {
+    "name": ("name", "town", "facility", "site_name", "label", "title"),
+    "address": ("address", "addr", "street", "full_addr", "location"),
+    "zip": ("zip", "zipcode", "zip_code", "postal"),
+    "city": ("city", "town", "municipality"),
+}
+
+# Bytes read from the start of an uploaded CSV to pick its encoding
+CSV_SNIFF_BYTES = 65536
+# Lower-cased CSV headers read by import_csv
+CSV_COLUMNS = (
+    "name", "libname", "address", "city", "zip", "hours", "remarks",
+    "latitude", "longitude", "longitud",
+)
 
 
 class BathroomCsvImportForm(forms.Form):
@@ -59,25 +89,32 @@ class BathroomAdmin(admin.ModelAdmin):
             form = BathroomCsvImportForm(request.POST, request.FILES)
             if form.is_valid():
                 csv_file = form.cleaned_data["csv_file"]
-                raw_bytes = csv_file.read()
-                decoded = None
-                for encoding in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
-                    try:
-                        decoded = raw_bytes.decode(encoding)
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                if decoded is None:
-                    messages.error(
-                        request,
-                        "Could not decode CSV. Try saving as UTF-8 in Excel or another editor.",
-                    )
-                    return redirect("..")
+                # Sniff the encoding from the start of the file, then stream the
+                # rest through the decoder instead of reading it all into memory.
+                head = csv_file.read(CSV_SNIFF_BYTES)
+                if head.startswith(codecs.BOM_UTF8):
+                    encoding = "utf-8-sig"
+                elif head[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+                    encoding = "utf-16"
+                else:
+                    best = from_bytes(head).best()
+                    encoding = best.encoding if best else "utf-8"
+                    # An ASCII prefix says nothing about the rest of the file
+                    if encoding == "ascii":
+                        encoding = "utf-8"
+
+                csv_file.seek(0)
+                stream = io.TextIOWrapper(
+                    csv_file.file, encoding=encoding, errors="replace", newline=""
+                )
+                reader = csv.reader(stream)
+                header = [field.strip().lower() for field in next(reader, [])]
+                idx = {key: header.index(key) for key in CSV_COLUMNS if key in header}
+
+                def value(row, key):
+                    i = idx.get(key)
+                    return row[i] if i is not None and i < len(row) else ""
 
-                reader = csv.DictReader(io.StringIO(decoded))
-                header = [
-                    field.strip().lower() for field in (reader.fieldnames or [])
-                ]
                 required = {"address", "zip"}
                 missing = required - set(header)
                 if missing:
@@ -87,65 +124,85 @@ class BathroomAdmin(admin.ModelAdmin):
                     )
                     return redirect("..")
 
-                geocoder = Nominatim(user_agent="bathroom_map_3")
-                created_count = 0
                 errors = []
+                parsed_rows = []
+                pending = []
+
+                # Geocode each unique address on a background thread while the
+                # rest of the CSV is still being parsed.
+                with ThreadPoolExecutor(max_workers=1) as executor:
+
+                    @functools.lru_cache(maxsize=4096)
+                    def lookup(address, zip_code):
+                        return executor.submit(geocode, address, zip_code)
+
+                    rows = (row for row in reader if row)
+                    for row_index, row in enumerate(rows, start=2):
+                        name = (
+                            value(row, "name")
+                            or value(row, "libname")
+                            or ""
+                        ).strip()
+                        address = (value(row, "address") or "").strip()
+                        city = (value(row, "city") or "").strip()
+                        if city and address:
+                            address = "{}, {}".format(address, city)
+                        zip_code = (value(row, "zip") or "").strip()
+                        if len(zip_code) > 5 and zip_code[:5].isdigit():
+                            zip_code = zip_code[:5]
+                        hours_raw = (
+                            value(row, "hours") or ""
+                        ).strip()
+                        if hours_raw and not self._is_bogus_hours(hours_raw):
+                            hours = hours_raw
+                        else:
+                            hours = ""
+                        remarks = (value(row, "remarks") or "").strip()
+
+                        if not address or not zip_code:
+                            errors.append(
+                                "Row {}: address and zip are required.".format(row_index)
+                            )
+                            continue
 
-                for row_index, row in enumerate(reader, start=2):
-                    normalized_row = self._normalize_row(row)
-                    name = (
-                        normalized_row.get("name")
-                        or normalized_row.get("libname")
-                        or ""
-                    ).strip()
-                    address = (normalized_row.get("address") or "").strip()
-                    city = (normalized_row.get("city") or "").strip()
-                    if city and address:
-                        address = "{}, {}".format(address, city)
-                    zip_code = (normalized_row.get("zip") or "").strip()
-                    if len(zip_code) > 5 and zip_code[:5].isdigit():
-                        zip_code = zip_code[:5]
-                    hours_raw = (
-                        normalized_row.get("hours") or ""
-                    ).strip()
-                    if hours_raw and not self._is_bogus_hours(hours_raw):
-                        hours = hours_raw
-                    else:
-                        hours = ""
-                    remarks = (normalized_row.get("remarks") or "").strip()
+                        latitude, longitude = self._parse_lat_long(
+                            value(row, "latitude"),
+                            value(row, "longitude") or value(row, "longitud"),
+                            row_index,
+                            errors,
+                        )
+                        geocoded = None
+                        if not latitude or not longitude:
+                            geocoded = lookup(address, zip_code)
 
-                    if not address or not zip_code:
-                        errors.append(
-                            "Row {}: address and zip are required.".format(row_index)
+                        parsed_rows.append(
+                            (name, address, zip_code, latitude, longitude, hours, remarks, geocoded)
                         )
-                        continue
 
-                    latitude, longitude = self._parse_lat_long(
-                        normalized_row, row_index, errors
+                    for row in parsed_rows:
+                        name, address, zip_code, latitude, longitude, hours, remarks, geocoded = row
+                        location = geocoded.result() if geocoded is not None else None
+                        if location:
+                            latitude, longitude = location
+
+                        pending.append(Bathroom(
+                            name=name,
+                            address=address,
+                            address_normalized=normalize_address(address, zip_code),
+                            zip=zip_code,
+                            latitude=latitude or _DEC_ZERO,
+                            longitude=longitude or _DEC_ZERO,
+                            hours=hours,
+                            remarks=remarks,
+                        ))
+
+                stream.detach()
+
+                with transaction.atomic():
+                    Bathroom.objects.bulk_create(
+                        pending, batch_size=self._bulk_batch_size()
                     )
-                    if not latitude or not longitude:
-                        try:
-                            location = geocoder.geocode(
-                                "{}, {}".format(address, zip_code)
-                            )
-                            if location:
-                                latitude, longitude = (
-                                    Decimal(str(location.latitude)),
-                                    Decimal(str(location.longitude)),
-                                )
-                        except Exception:
-                            pass
-
-                    Bathroom.objects.create(
-                        name=name,
-                        address=address,
-                        zip=zip_code,
-                        latitude=latitude or Decimal("0"),
-                        longitude=longitude or Decimal("0"),
-                        hours=hours,
-                        remarks=remarks,
-                    )
-                    created_count += 1
+                created_count = len(pending)
 
                 if errors:
                     messages.warning(
@@ -226,15 +283,25 @@ class BathroomAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(request.META.get("HTTP_REFERER", ".."))
 
     def _process_shapefile(self, zip_file):
-        zip_file.seek(0)
         with tempfile.TemporaryDirectory() as tmpdir:
-            with zipfile.ZipFile(zip_file, "r") as zf:
-                zf.extractall(tmpdir)
+            # Read the archive from disk. Django already spools large uploads
+            # to a temp file; anything still in memory is copied out in chunks.
+            if hasattr(zip_file, "temporary_file_path"):
+                zip_path = zip_file.temporary_file_path()
+            else:
+                zip_path = os.path.join(tmpdir, "upload.zip")
+                zip_file.seek(0)
+                with open(zip_path, "wb") as out:
+                    shutil.copyfileobj(zip_file, out, 65536)
+
+            extract_dir = os.path.join(tmpdir, "shapefile")
+            with zipfile.ZipFile(zip_path, "r") as zf:
+                zf.extractall(extract_dir)
 
             shp_path = None
-            for f in os.listdir(tmpdir):
+            for f in os.listdir(extract_dir):
                 if f.lower().endswith(".shp"):
-                    shp_path = os.path.join(tmpdir, f)
+                    shp_path = os.path.join(extract_dir, f)
                     break
 
             if not shp_path:
@@ -256,115 +323,153 @@ class BathroomAdmin(admin.ModelAdmin):
                 except Exception:
                     pass
 
-            sf = shapefile.Reader(shp_path)
-            fields = [f[0].lower() for f in sf.fields[1:]]
-
-            def get_attr(record, *keys):
-                for k in keys:
-                    if k in field_idx:
-                        val = record[field_idx[k]]
-                        if val is not None and str(val).strip():
-                            return str(val).strip()
-                return ""
-
-            field_idx = {f.lower(): i for i, f in enumerate(fields)}
-            name_keys = ("name", "town", "facility", "site_name", "label", "title")
-            addr_keys = ("address", "addr", "street", "full_addr", "location")
-            zip_keys = ("zip", "zipcode", "zip_code", "postal")
-            city_keys = ("city", "town", "municipality")
-
-            created_count = 0
-            errors = []
-
-            for i, (shape, record) in enumerate(zip(sf.shapes(), sf.records())):
-                if shape.shapeType not in (
-                    shapefile.POINT,
-                    shapefile.POINTZ,
-                    shapefile.POINTM,
-                ):
-                    errors.append("Row {}: not a point (skipped).".format(i + 1))
-                    continue
-                if not shape.points:
-                    errors.append("Row {}: empty point (skipped).".format(i + 1))
-                    continue
-
-                try:
-                    x, y = shape.points[0][0], shape.points[0][1]
-                    if x is None or y is None:
-                        raise ValueError("Missing coordinates")
-                    x_f, y_f = float(x), float(y)
-                    if not (math.isfinite(x_f) and math.isfinite(y_f)):
-                        raise ValueError("Non-finite coordinates")
-
-                    if transformer is not None:
-                        lon_f, lat_f = transformer.transform(x_f, y_f)
-                    else:
-                        lon_f, lat_f = x_f, y_f
+            with shapefile.Reader(shp_path) as sf:
+                # Resolve which record positions hold each attribute once, up front
+                field_idx = {f[0].lower(): i for i, f in enumerate(sf.fields[1:])}
+                columns = {
+                    attr: tuple(field_idx[k] for k in keys if k in field_idx)
+                    for attr, keys in SHAPEFILE_ATTR_KEYS.items()
+                }
+                batch_size = self._bulk_batch_size()
+                created_count = 0
+                errors = []
 
-                    if lat_f < -90 or lat_f > 90 or lon_f < -180 or lon_f > 180:
-                        raise ValueError(
-                            "Coordinates out of range. Include the .prj file in the ZIP "
-                            "if the shapefile uses a projected coordinate system."
-                        )
-                    latitude = Decimal(str(round(lat_f, 6)))
-                    longitude = Decimal(str(round(lon_f, 6)))
-                except (ValueError, TypeError, IndexError, InvalidOperation) as e:
-                    errors.append("Row {}: invalid coordinates (skipped): {}".format(i + 1, e))
-                    continue
-
-                name = get_attr(record, *name_keys)
-                address = get_attr(record, *addr_keys)
-                city = get_attr(record, *city_keys)
-                if city and address:
-                    address = "{}, {}".format(address, city)
-                elif city and not address:
-                    address = city
-                zip_code = get_attr(record, *zip_keys)
-                if len(zip_code) > 5 and zip_code[:5].isdigit():
-                    zip_code = zip_code[:5]
-
-                if not address:
-                    address = name or "Address unavailable"
-                if not zip_code:
-                    zip_code = "00000"
-                if not name:
-                    name = address
-
-                Bathroom.objects.create(
-                    name=name,
-                    address=address,
-                    zip=zip_code,
-                    latitude=latitude,
-                    longitude=longitude,
-                    hours="",
-                    remarks="",
-                )
-                created_count += 1
+                # Stream shape records and flush every batch_size rows so memory
+                # stays bounded no matter how large the shapefile is.
+                with transaction.atomic():
+                    batch = []
+                    for i, shape_record in enumerate(sf.iterShapeRecords()):
+                        batch.append((i, shape_record.shape, shape_record.record))
+                        if len(batch) >= batch_size:
+                            pending = self._shapefile_batch(batch, columns, transformer, errors)
+                            Bathroom.objects.bulk_create(pending, batch_size=batch_size)
+                            created_count += len(pending)
+                            batch = []
+                    if batch:
+                        pending = self._shapefile_batch(batch, columns, transformer, errors)
+                        Bathroom.objects.bulk_create(pending, batch_size=batch_size)
+                        created_count += len(pending)
 
         return created_count, errors
 
+    def _shapefile_batch(self, batch, columns, transformer, errors):
+        """Build unsaved Bathrooms from a batch of (row index, shape, record) tuples."""
+        def get_attr(record, positions):
+            for i in positions:
+                val = record[i]
+                if val is not None:
+                    val = str(val).strip()
+                    if val:
+                        return val
+            return ""
+
+        name_ix = columns["name"]
+        addr_ix = columns["address"]
+        zip_ix = columns["zip"]
+        city_ix = columns["city"]
+        point_types = (shapefile.POINT, shapefile.POINTZ, shapefile.POINTM)
+
+        # Pull each row's source point; rows that can't supply one keep NaN and
+        # get their error recorded here, in row order.
+        xs = np.full(len(batch), np.nan)
+        ys = np.full(len(batch), np.nan)
+        problems = [None] * len(batch)
+        for j, (i, shape, record) in enumerate(batch):
+            if shape.shapeType not in point_types:
+                problems[j] = "Row {}: not a point (skipped).".format(i + 1)
+                continue
+            if not shape.points:
+                problems[j] = "Row {}: empty point (skipped).".format(i + 1)
+                continue
+            try:
+                x, y = shape.points[0][0], shape.points[0][1]
+                if x is None or y is None:
+                    raise ValueError("Missing coordinates")
+                x_f, y_f = float(x), float(y)
+                if not (math.isfinite(x_f) and math.isfinite(y_f)):
+                    raise ValueError("Non-finite coordinates")
+                xs[j], ys[j] = x_f, y_f
+            except (ValueError, TypeError, IndexError) as e:
+                problems[j] = "Row {}: invalid coordinates (skipped): {}".format(i + 1, e)
+
+        # Project and range-check the whole batch in one go
+        if transformer is not None:
+            lons, lats = transformer.transform(xs, ys)
+        else:
+            lons, lats = xs, ys
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        valid = (
+            np.isfinite(lats) & np.isfinite(lons)
+            & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+        )
+        for j in np.flatnonzero(~valid).tolist():
+            if problems[j] is None:
+                problems[j] = (
+                    "Row {}: invalid coordinates (skipped): Coordinates out of range. "
+                    "Include the .prj file in the ZIP if the shapefile uses a "
+                    "projected coordinate system.".format(batch[j][0] + 1)
+                )
+        errors.extend(p for p in problems if p is not None)
+
+        pending = []
+        lats, lons = lats.tolist(), lons.tolist()
+        for j in np.flatnonzero(valid).tolist():
+            if problems[j] is not None:
+                continue
+            i, shape, record = batch[j]
+            # DecimalField quantizes to 6 places when the row is saved
+            latitude = round(lats[j], 6)
+            longitude = round(lons[j], 6)
+
+            name = get_attr(record, name_ix)
+            address = get_attr(record, addr_ix)
+            city = get_attr(record, city_ix)
+            if city and address:
+                address = "{}, {}".format(address, city)
+            elif city and not address:
+                address = city
+            zip_code = get_attr(record, zip_ix)
+            if len(zip_code) > 5 and zip_code[:5].isdigit():
+                zip_code = zip_code[:5]
+
+            if not address:
+                address = name or "Address unavailable"
+            if not zip_code:
+                zip_code = "00000"
+            if not name:
+                name = address
+
+            pending.append(Bathroom(
+                name=name,
+                address=address,
+                address_normalized=normalize_address(address, zip_code),
+                zip=zip_code,
+                latitude=latitude,
+                longitude=longitude,
+                hours="",
+                remarks="",
+            ))
+
+        return pending
+
+    def _bulk_batch_size(self):
+        return getattr(settings, "BATHROOM_BULK_BATCH", 500)
+
     def _is_bogus_hours(self, hours):
         if not hours or not hours.strip():
             return True
         s = hours.strip()
-        if re.match(r"^[\d\s,\.]+$", s):
-            return True
-        if len(s) <= 4 and s.replace(".", "").isdigit():
-            return True
-        return False
-
-    def _normalize_row(self, row):
-        return {
-            (key or "").strip().lower(): value
-            for key, value in row.items()
-        }
+        return bool(_BOGUS_HOURS_RE.match(s)) or (
+            len(s) <= 4 and bool(_SHORT_NUM_RE.match(s.replace(".", "")))
+        )
 
-    def _parse_lat_long(self, row, row_index, errors):
+    def _parse_lat_long(self, lat_raw, lon_raw, row_index, errors):
         latitude = None
         longitude = None
 
-        lat_raw = (row.get("latitude") or "").strip()
-        lon_raw = (row.get("longitude") or row.get("longitud") or "").strip()
+        lat_raw = (lat_raw or "").strip()
+        lon_raw = (lon_raw or "").strip()
 
         if lat_raw:
             try:
@@ -373,6 +478,12 @@ class BathroomAdmin(admin.ModelAdmin):
                 errors.append(
                     "Row {}: invalid latitude '{}'.".format(row_index, lat_raw)
                 )
+            else:
+                if not (latitude.is_finite() and -90 <= latitude <= 90):
+                    errors.append(
+                        "Row {}: latitude '{}' out of range.".format(row_index, lat_raw)
+                    )
+                    latitude = None
 
         if lon_raw:
             try:
@@ -381,15 +492,39 @@ class BathroomAdmin(admin.ModelAdmin):
                 errors.append(
                     "Row {}: invalid longitude '{}'.".format(row_index, lon_raw)
                 )
+            else:
+                if not (longitude.is_finite() and -180 <= longitude <= 180):
+                    errors.append(
+                        "Row {}: longitude '{}' out of range.".format(row_index, lon_raw)
+                    )
+                    longitude = None
 
         return latitude, longitude
     
     def save_model(self, request, obj, form, change):
-        geocoder = Nominatim(user_agent='bathroom_map_3')
-        location = geocoder.geocode(obj.address + ", " + obj.zip)
+        geocoded = False
+        deferred = False
         if not (obj.latitude and obj.longitude):
-            try:
-                obj.latitude, obj.longitude = location.latitude, location.longitude
-            except:
-                pass
-        super().save_model(request, obj, form, change)
+            if getattr(settings, "GEOCODE_SYNC", False):
+                location = geocode(obj.address, obj.zip)
+                if location:
+                    obj.latitude, obj.longitude = location
+                    geocoded = True
+            else:
+                # Placeholder until the background lookup writes the real coords
+                obj.latitude = obj.longitude = _DEC_ZERO
+                deferred = True
+        if change:
+            # Only write the columns this edit actually touched
+            update_fields = set(form.changed_data)
+            if geocoded or deferred:
+                update_fields.update(("latitude", "longitude"))
+            if update_fields & {"address", "zip"}:
+                # pre_save recomputes it, but update_fields decides whether it is written
+                update_fields.add("address_normalized")
+            obj.save(update_fields=update_fields)
+        else:
+            super().save_model(request, obj, form, change)
+        if deferred:
+            pk = obj.pk
+            transaction.on_commit(lambda: geocode_bathroom_later(pk))
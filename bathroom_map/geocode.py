@@ -0,0 +1,108 @@
+"""
+Shared Nominatim geocoder with a persistent on-disk cache.
+
+One process-wide geocoder keeps its HTTP session alive between calls and is
+rate limited per the Nominatim usage policy. Results are cached on disk keyed
+by the normalized "address, zip" (or "geo:city|state" for places) so repeat
+lookups never hit the network.
+Admin saves hand lookups to a background thread via geocode_bathroom_later().
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import diskcache
+from django.conf import settings
+from django.db import connection
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
+from geopy.geocoders import Nominatim
+
+USER_AGENT = "bathroom_map_3"
+
+_geocoder = Nominatim(user_agent=USER_AGENT, adapter_factory=RequestsAdapter)
+_geocode = RateLimiter(
+    _geocoder.geocode,
+    min_delay_seconds=1.05,
+    max_retries=2,
+    # Back off before retrying a failed request instead of retrying at the normal pace
+    error_wait_seconds=2.0,
+    swallow_exceptions=False,
+)
+# Place lookups can go stale (boundaries, renames), so they expire after 30 days
+PLACE_CACHE_TTL = 30 * 86400
+_cache = None
+# A single worker keeps background lookups serialized behind the rate limiter
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="geocode")
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = diskcache.Cache(
+            settings.GEOCODE_CACHE_DIR, eviction_policy="least-recently-used"
+        )
+    return _cache
+
+
+def normalize_key(address, zip_code):
+    """Return the cache key for an address, e.g. ' 1 Main  St', '02101' -> '1 main st,02101'."""
+    return re.sub(r"\s+", " ", ((address or "") + "," + (zip_code or "")).lower().strip())
+
+
+def geocode(address, zip_code):
+    """Return (latitude, longitude) for an address and zip, or None if it can't be found."""
+    cache = _get_cache()
+    key = normalize_key(address, zip_code)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        location = _geocode("{}, {}".format(address, zip_code))
+    except Exception:
+        return None
+    if not location:
+        return None
+    result = (location.latitude, location.longitude)
+    cache.set(key, result)
+    return result
+
+
+def geocode_place(city, state):
+    """Return (latitude, longitude) for a city and state, or None if it can't be found."""
+    cache = _get_cache()
+    key = "geo:{}|{}".format(city, state)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        location = _geocode("{}, {}".format(city, state))
+    except Exception:
+        return None
+    if not location:
+        return None
+    result = (location.latitude, location.longitude)
+    cache.set(key, result, expire=PLACE_CACHE_TTL)
+    return result
+
+
+def geocode_bathroom(pk):
+    """Geocode a saved Bathroom's address and write the coordinates back."""
+    from .models import Bathroom
+
+    try:
+        bathroom = Bathroom.objects.only("address", "zip").filter(pk=pk).first()
+        if bathroom is None:
+            return
+        location = geocode(bathroom.address, bathroom.zip)
+        if location:
+            Bathroom.objects.filter(pk=pk).update(
+                latitude=location[0], longitude=location[1]
+            )
+    finally:
+        # The worker thread owns its own connection; don't leave it open
+        connection.close()
+
+
+def geocode_bathroom_later(pk):
+    """Queue geocode_bathroom(pk) on the background worker and return its future."""
+    return _executor.submit(geocode_bathroom, pk)
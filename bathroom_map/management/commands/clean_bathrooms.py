@@ -6,16 +6,44 @@ Deduplicate bathrooms, fix title case, and clear bogus hours.
 - Adds state abbreviation to addresses when missing (from zip code)
 - Clears hours when it's a numeric code (e.g. from PLS data) rather than real hours
 """
-import json
+import asyncio
 import re
-import time
-import urllib.request
-from collections import defaultdict
 
+import aiohttp
+import diskcache
+import orjson
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from bathroom_map.models import Bathroom
-from bathroom_map.utils import US_STATE_ABBREVS, ensure_state_in_address
+from bathroom_map.utils import US_STATE_ABBREVS, ensure_state_in_address, normalize_address
+
+_BOGUS_HOURS_RE = re.compile(r"^[\d\s,.]+$")
+_SHORT_NUM_RE = re.compile(r"^\d+(\.\d+)?$")
+# A whitespace-delimited two-letter word, e.g. the "MA" in "Boston MA"
+_STATE_FIX_RE = re.compile(r"(?<!\S)([A-Za-z]{2})(?!\S)")
+# SQL equivalent of is_bogus_hours(): digits, spaces, commas and dots, not blank
+BOGUS_HOURS_SQL_RE = r"^[\s0-9,.]*[0-9,.][\s0-9,.]*$"
+
+# Ids per DELETE ... WHERE id IN (...); keeps well under SQLite's 999 bound parameters
+DEDUP_DELETE_BATCH = 500
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_QUERY = (
+    "[out:json][timeout:5];"
+    "(node(around:80,{lat},{lon})[opening_hours];"
+    "way(around:80,{lat},{lon})[opening_hours];);"
+    "out body tags;"
+)
+# Overpass tolerates a few concurrent requests per client
+OVERPASS_CONCURRENCY = 4
+# Cached Overpass answers; misses are kept briefly so failures aren't retried every run
+OVERPASS_CACHE_TTL = 30 * 86400
+OVERPASS_NEGATIVE_CACHE_TTL = 86400
+
+_MISS = object()
+_hours_cache = None
 
 
 def ensure_suffix(name):
@@ -33,43 +61,83 @@ def ensure_suffix(name):
     return n
 
 
-def fetch_hours_from_osm(lat, lon):
+async def fetch_hours_from_osm(session, sem, lat, lon):
     """Query OSM Overpass for opening_hours near point. Returns hours string or None."""
-    try:
-        url = (
-            "https://overpass-api.de/api/interpreter?"
-            "data=[out:json][timeout:5];"
-            "(node(around:80,{},{})[opening_hours];"
-            "way(around:80,{},{})[opening_hours];);"
-            "out body tags;"
-        ).format(lat, lon, lat, lon)
-        req = urllib.request.Request(url, headers={"User-Agent": "BathroomAccess/1.0"})
-        with urllib.request.urlopen(req, timeout=5) as r:
-            data = json.loads(r.read().decode())
-        for el in data.get("elements", []):
-            tags = el.get("tags", {})
-            hours = tags.get("opening_hours") or tags.get("opening_hours:source")
-            if hours and len(hours) > 3 and not re.match(r"^[\d\s,\.]+$", hours.strip()):
-                return hours.strip()
-    except Exception:
-        pass
+    async with sem:
+        try:
+            async with session.get(
+                OVERPASS_URL,
+                params={"data": OVERPASS_QUERY.format(lat=lat, lon=lon)},
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as r:
+                data = orjson.loads(await r.read())
+            for el in data.get("elements", []):
+                tags = el.get("tags", {})
+                hours = tags.get("opening_hours") or tags.get("opening_hours:source")
+                if hours and len(hours) > 3 and not _BOGUS_HOURS_RE.match(hours.strip()):
+                    return hours.strip()
+        except Exception:
+            pass
+        finally:
+            # Stay under the Overpass fair-use limits
+            await asyncio.sleep(0.25)
     return None
 
 
+def _get_hours_cache():
+    global _hours_cache
+    if _hours_cache is None:
+        _hours_cache = diskcache.Cache(settings.OVERPASS_CACHE_DIR)
+    return _hours_cache
+
+
+def _hours_cache_key(lat, lon):
+    # ~11m grid; points this close get the same answer from an 80m Overpass query
+    return (round(lat, 4), round(lon, 4))
+
+
+async def fetch_all_hours(points):
+    """Fetch OSM hours for each (lat, lon) in points, querying Overpass only for uncached spots."""
+    cache = _get_hours_cache()
+    keys = [_hours_cache_key(lat, lon) for lat, lon in points]
+    found = {}
+    misses = []
+    for key in dict.fromkeys(keys):
+        hit = cache.get(key, default=_MISS)
+        if hit is _MISS:
+            misses.append(key)
+        else:
+            found[key] = hit
+
+    if misses:
+        sem = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+        async with aiohttp.ClientSession(headers={"User-Agent": "BathroomAccess/1.0"}) as session:
+            results = await asyncio.gather(
+                *(fetch_hours_from_osm(session, sem, lat, lon) for lat, lon in misses)
+            )
+        for key, hrs in zip(misses, results):
+            found[key] = hrs
+            cache.set(
+                key,
+                hrs,
+                expire=OVERPASS_CACHE_TTL if hrs else OVERPASS_NEGATIVE_CACHE_TTL,
+            )
+
+    return [found[key] for key in keys]
+
+
+def _upper_state(match):
+    word = match.group(1)
+    upp = word.upper()
+    return upp if upp in US_STATE_ABBREVS else word
+
+
 def title_case(s):
     """Convert 'CITYNAME TOWN HALL' to 'Cityname Town Hall'. Preserves state abbreviations (MA, CA, etc)."""
     if not s or not s.strip():
         return s
-    parts = s.strip().split()
-    result = []
-    for word in parts:
-        upp = word.upper()
-        # Preserve 2-letter state abbreviations (MA, CA, NY)
-        if len(word) == 2 and upp in US_STATE_ABBREVS:
-            result.append(upp)
-        else:
-            result.append(word.title())
-    return " ".join(result)
+    # str.title() does the heavy lifting in C; then restore 2-letter state abbreviations (MA, CA, NY)
+    return _STATE_FIX_RE.sub(_upper_state, " ".join(s.split()).title())
 
 
 def is_bogus_hours(hours):
@@ -77,13 +145,36 @@ def is_bogus_hours(hours):
     if not hours or not hours.strip():
         return False
     stripped = hours.strip()
-    # Purely numeric (with optional spaces, commas, decimals) = bogus
-    if re.match(r"^[\d\s,\.]+$", stripped):
-        return True
-    # Very short numeric-looking string
-    if len(stripped) <= 4 and stripped.replace(".", "").isdigit():
-        return True
-    return False
+    # Purely numeric (with optional spaces, commas, decimals) = bogus,
+    # as is a very short numeric-looking string
+    return bool(_BOGUS_HOURS_RE.match(stripped)) or (
+        len(stripped) <= 4 and bool(_SHORT_NUM_RE.match(stripped.replace(".", "")))
+    )
+
+
+def normalize_row(b):
+    """
+    Return (name, address, steps) for a bathroom after title-casing, adding the
+    state abbreviation and adding the Library/Town Hall suffix. steps holds one
+    bool per fix telling whether it changed anything.
+    """
+    # 1. Title-case name and address
+    name = title_case(b.name)
+    address = title_case(b.address)
+    title_cased = name != b.name or address != b.address
+
+    # 2. Add state abbreviation to addresses when missing
+    state_addr = ensure_state_in_address(address or "", b.zip or "")
+    state_added = bool(state_addr) and state_addr != (address or "")
+    if state_added:
+        address = state_addr
+
+    # 3. Add Library/Town Hall suffix
+    suffixed_name = ensure_suffix(title_case(name))
+    suffixed = suffixed_name != name
+    name = suffixed_name
+
+    return name, address, (title_cased, state_added, suffixed)
 
 
 class Command(BaseCommand):
@@ -106,103 +197,88 @@ class Command(BaseCommand):
         if dry_run:
             self.stdout.write("DRY RUN - no changes will be saved\n")
 
-        # 1. Title-case name and address
-        updated = 0
-        for b in Bathroom.objects.all():
-            new_name = title_case(b.name)
-            new_addr = title_case(b.address)
-            changed = False
-            if new_name != b.name:
-                if not dry_run:
-                    b.name = new_name
-                changed = True
-            if new_addr != b.address:
-                if not dry_run:
-                    b.address = new_addr
-                changed = True
-            if changed:
-                updated += 1
-                if not dry_run:
-                    b.save()
-
-        self.stdout.write("Title case: {} records updated".format(updated))
-
-        # 2. Add state abbreviation to addresses when missing
+        # 1-3. Title case, state abbreviation and suffix in a single scan
+        title_cased = 0
         state_added = 0
-        for b in Bathroom.objects.all():
-            new_addr = ensure_state_in_address(b.address or "", b.zip or "")
-            if new_addr and new_addr != (b.address or ""):
-                if not dry_run:
-                    b.address = new_addr
-                    b.save()
-                state_added += 1
-        self.stdout.write("State abbreviation added: {} records updated".format(state_added))
-
-        # 3. Add Library/Town Hall suffix
         suffixed = 0
-        for b in Bathroom.objects.all():
-            new_name = ensure_suffix(title_case(b.name))
-            if new_name != b.name:
-                if not dry_run:
-                    b.name = new_name
-                    b.save()
-                suffixed += 1
+        changed = []
+        qs = Bathroom.objects.only("id", "name", "address", "zip", "address_normalized")
+        for b in qs.iterator(chunk_size=2000):
+            new_name, new_addr, steps = normalize_row(b)
+            title_cased += steps[0]
+            state_added += steps[1]
+            suffixed += steps[2]
+            new_norm = normalize_address(new_addr, b.zip)
+            if (new_name, new_addr, new_norm) != (b.name, b.address, b.address_normalized):
+                b.name, b.address, b.address_normalized = new_name, new_addr, new_norm
+                changed.append(b)
+
+        if not dry_run:
+            Bathroom.objects.bulk_update(
+                changed, ["name", "address", "address_normalized"], batch_size=500
+            )
+
+        self.stdout.write("Title case: {} records updated".format(title_cased))
+        self.stdout.write("State abbreviation added: {} records updated".format(state_added))
         self.stdout.write("Library/Town Hall suffix: {} records updated".format(suffixed))
 
-        # 4. Clear bogus hours
-        cleared = 0
-        for b in Bathroom.objects.all():
-            if is_bogus_hours(b.hours):
-                if not dry_run:
-                    b.hours = ""
-                    b.save()
-                cleared += 1
+        # 4. Clear bogus hours in the database; only matching rows are touched
+        bogus = Bathroom.objects.filter(hours__regex=BOGUS_HOURS_SQL_RE)
+        cleared = bogus.count() if dry_run else bogus.update(hours="")
 
         self.stdout.write("Cleared bogus hours: {} records".format(cleared))
 
         # 5. Fetch hours from OSM for records missing hours
         hours_fetched = 0
         if not options.get("skip_hours_fetch", False):
-            for b in Bathroom.objects.all():
+            targets = []
+            qs = Bathroom.objects.only("id", "latitude", "longitude", "hours")
+            for b in qs.iterator(chunk_size=2000):
                 if not b.hours or not b.hours.strip() or is_bogus_hours(b.hours):
                     if b.latitude and b.longitude:
-                        lat, lon = float(b.latitude), float(b.longitude)
-                        if -90 <= lat <= 90 and -180 <= lon <= 180:
-                            hrs = fetch_hours_from_osm(lat, lon)
-                            if hrs:
-                                if not dry_run:
-                                    b.hours = hrs
-                                    b.save()
-                                hours_fetched += 1
-                            time.sleep(1.05)
+                        targets.append((b.id, float(b.latitude), float(b.longitude)))
+            results = asyncio.run(fetch_all_hours([(lat, lon) for _, lat, lon in targets]))
+            fetched = [
+                Bathroom(id=pk, hours=hrs)
+                for (pk, _, _), hrs in zip(targets, results)
+                if hrs
+            ]
+            if not dry_run:
+                Bathroom.objects.bulk_update(fetched, ["hours"], batch_size=500)
+            hours_fetched = len(fetched)
         self.stdout.write("Hours fetched from OSM: {} records".format(hours_fetched))
 
         # 6. Deduplicate by (lat, lon) rounded to 5 decimals (~1m)
-        def coord_key(b):
-            lat = float(b.latitude) if b.latitude else 0
-            lon = float(b.longitude) if b.longitude else 0
-            return (round(lat, 5), round(lon, 5))
-
-        groups = defaultdict(list)
-        for b in Bathroom.objects.all():
-            groups[coord_key(b)].append(b)
-
-        deleted = 0
-        for key, group in groups.items():
-            if len(group) <= 1:
-                continue
-            # Prefer record with hours or remarks
-            def score(r):
-                has_hrs = bool(r.hours and r.hours.strip() and not is_bogus_hours(r.hours))
-                has_rem = bool(r.remarks and r.remarks.strip())
-                return (has_hrs, has_rem, len(r.hours or "") + len(r.remarks or ""))
-
-            group.sort(key=score, reverse=True)
-            keep = group[0]
-            for dup in group[1:]:
-                if not dry_run:
-                    dup.delete()
-                deleted += 1
+        # Prefer record with hours or remarks
+        def score(hours, remarks):
+            has_hrs = bool(hours and hours.strip() and not is_bogus_hours(hours))
+            has_rem = bool(remarks and remarks.strip())
+            return (has_hrs, has_rem, len(hours or "") + len(remarks or ""))
+
+        best = {}
+        delete_ids = []
+        rows = Bathroom.objects.values_list("id", "latitude", "longitude", "hours", "remarks")
+        for pk, lat, lon, hours, remarks in rows.iterator(chunk_size=2000):
+            key = (
+                round(float(lat) if lat else 0, 5),
+                round(float(lon) if lon else 0, 5),
+            )
+            rank = score(hours, remarks)
+            kept = best.get(key)
+            if kept is None:
+                best[key] = (rank, pk)
+            elif rank > kept[0]:
+                delete_ids.append(kept[1])
+                best[key] = (rank, pk)
+            else:
+                delete_ids.append(pk)
+
+        if delete_ids and not dry_run:
+            with transaction.atomic():
+                for i in range(0, len(delete_ids), DEDUP_DELETE_BATCH):
+                    batch = delete_ids[i:i + DEDUP_DELETE_BATCH]
+                    Bathroom.objects.filter(id__in=batch).delete()
+        deleted = len(delete_ids)
 
         self.stdout.write("Duplicates removed: {} records".format(deleted))
 
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-14 19:09
+
+from django.db import migrations, models
+
+
+def create_rounded_latlon_index(apps, schema_editor):
+    # Expression indexes need raw SQL on Django 2.2; only PostgreSQL gets one
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS bath_round_latlon_idx ON bathroom_map_bathroom '
+        '((ROUND(latitude::numeric, 5)), (ROUND(longitude::numeric, 5)))'
+    )
+
+
+def drop_rounded_latlon_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS bath_round_latlon_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bathroom_map', '0004_auto_20210609_1847'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bathroom',
+            index=models.Index(fields=['latitude', 'longitude'], name='bath_latlon_idx'),
+        ),
+        migrations.RunPython(create_rounded_latlon_index, drop_rounded_latlon_index),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-14 21:02
+
+from django.db import migrations, models
+
+from bathroom_map.utils import normalize_address
+
+
+def fill_address_normalized(apps, schema_editor):
+    Bathroom = apps.get_model('bathroom_map', 'Bathroom')
+    batch = []
+    for b in Bathroom.objects.only('id', 'address', 'zip').iterator(chunk_size=2000):
+        b.address_normalized = normalize_address(b.address, b.zip)
+        batch.append(b)
+        if len(batch) >= 500:
+            Bathroom.objects.bulk_update(batch, ['address_normalized'])
+            batch = []
+    if batch:
+        Bathroom.objects.bulk_update(batch, ['address_normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bathroom_map', '0005_bathroom_latlon_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bathroom',
+            name='address_normalized',
+            field=models.CharField(blank=True, default='', editable=False, max_length=515),
+        ),
+        migrations.RunPython(fill_address_normalized, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-14 21:40
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def reset_out_of_range_coordinates(apps, schema_editor):
+    # Out-of-range rows would fail the new constraints; give them the 0/0
+    # placeholder used for not-yet-geocoded rows so the next save re-geocodes
+    Bathroom = apps.get_model('bathroom_map', 'Bathroom')
+    bad = (
+        models.Q(latitude__lt=-90) | models.Q(latitude__gt=90)
+        | models.Q(longitude__lt=-180) | models.Q(longitude__gt=180)
+    )
+    Bathroom.objects.filter(bad).update(latitude=0, longitude=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bathroom_map', '0006_bathroom_address_normalized'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_out_of_range_coordinates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='bathroom',
+            name='latitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AlterField(
+            model_name='bathroom',
+            name='longitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.AddConstraint(
+            model_name='bathroom',
+            constraint=models.CheckConstraint(check=models.Q(('latitude__gte', -90), ('latitude__lte', 90)), name='bath_lat_range'),
+        ),
+        migrations.AddConstraint(
+            model_name='bathroom',
+            constraint=models.CheckConstraint(check=models.Q(('longitude__gte', -180), ('longitude__lte', 180)), name='bath_lon_range'),
+        ),
+    ]
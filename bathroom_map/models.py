@@ -1,10 +1,42 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from .utils import normalize_address
 
 class Bathroom(models.Model):
     name = models.CharField(max_length=255, blank=True)
     address = models.CharField(max_length=511)
     zip = models.CharField(max_length=5)
-    latitude = models.DecimalField(max_digits=9, decimal_places=6, blank=True)
-    longitude = models.DecimalField(max_digits=9, decimal_places=6, blank=True)
+    latitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)],
+    )
+    longitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)],
+    )
     hours = models.TextField(blank=True)
-    remarks = models.TextField(blank=True)
\ No newline at end of file
+    remarks = models.TextField(blank=True)
+    # Address as displayed (state appended from the zip); kept in sync on save
+    address_normalized = models.CharField(max_length=515, blank=True, default="", editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["latitude", "longitude"], name="bath_latlon_idx"),
+        ]
+        # Readers rely on these instead of re-checking every row
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(latitude__gte=-90, latitude__lte=90), name="bath_lat_range"
+            ),
+            models.CheckConstraint(
+                check=models.Q(longitude__gte=-180, longitude__lte=180), name="bath_lon_range"
+            ),
+        ]
+
+
+@receiver(pre_save, sender=Bathroom)
+def _set_address_normalized(sender, instance, **kwargs):
+    instance.address_normalized = normalize_address(instance.address, instance.zip)
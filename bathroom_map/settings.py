@@ -129,6 +129,16 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR
 
+# On-disk cache of Nominatim geocoding results (see bathroom_map/geocode.py)
+GEOCODE_CACHE_DIR = os.path.join(BASE_DIR, '.cache', 'geocode')
+# On-disk cache of OSM Overpass opening hours (see clean_bathrooms command)
+OVERPASS_CACHE_DIR = os.path.join(BASE_DIR, '.cache', 'overpass')
+# Geocode admin saves inline instead of on the background worker
+GEOCODE_SYNC = os.environ.get("GEOCODE_SYNC", "") == "1"
+
+# Rows per INSERT when bulk-importing bathrooms from CSV/Shapefile
+BATHROOM_BULK_BATCH = int(os.environ.get("BATHROOM_BULK_BATCH", "500"))
+
 LEAFLET_CONFIG = {
     'SPATIAL_EXTENT': (-71.07, 42.382, -71.12, 42.389)
 }
@@ -1,8 +1,11 @@
 """
 Utilities for address parsing, place extraction, and state abbreviations.
 """
+import functools
 import re
 
+import zipcodes
+
 # US state abbreviations - preserve these (don't title-case to "Ma", "Ca")
 US_STATE_ABBREVS = frozenset([
     "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "FL", "GA",
@@ -12,6 +15,15 @@ US_STATE_ABBREVS = frozenset([
     "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY", "DC",
 ])
 
+# Every casing of each abbreviation ("MA", "ma", "Ma", "mA") for case-insensitive membership
+# tests on raw address parts without allocating an upper-cased copy
+_STATE_ABBREVS_ANY_CASE = frozenset(
+    a + b for s in US_STATE_ABBREVS for a in (s[0], s[0].lower()) for b in (s[1], s[1].lower())
+)
+
+# Splits an address on commas, swallowing the whitespace around each one
+_COMMA_SPLIT = re.compile(r"\s*,\s*")
+
 # Map state abbreviation to full name (for city URL slugs like belmont-massachusetts)
 STATE_ABBREV_TO_FULL = {
     "AL": "alabama", "AK": "alaska", "AZ": "arizona", "AR": "arkansas",
@@ -32,6 +44,11 @@ STATE_ABBREV_TO_FULL = {
 
 # Known state slug suffixes for parsing city param (multi-word states)
 STATE_SLUGS = frozenset(v for v in STATE_ABBREV_TO_FULL.values())
+# A whole state slug at the end of a city slug; the leftmost match is the longest,
+# so "charleston-west-virginia" ends in "west-virginia", not "virginia"
+_STATE_SUFFIX_RE = re.compile(
+    r"(?:^|-)(" + "|".join(re.escape(s) for s in sorted(STATE_SLUGS, key=len, reverse=True)) + r")$"
+)
 
 
 def city_slug(city_name, state_abbrev):
@@ -49,19 +66,28 @@ def parse_city_slug(slug):
     """Parse 'belmont-massachusetts' or 'concord-new-hampshire' -> (city, state) for geocoding."""
     if not slug or not isinstance(slug, str):
         return (None, None)
-    parts = slug.lower().strip().split("-")
-    if len(parts) < 2:
+    slug = slug.lower().strip()
+    if "-" not in slug:
         return (None, None)
-    for n in range(1, min(5, len(parts)) + 1):
-        state_slug = "-".join(parts[-n:])
-        if state_slug in STATE_SLUGS:
-            city_slug = "-".join(parts[:-n]) if len(parts) > n else ""
-            city = city_slug.replace("-", " ")
-            state = state_slug.replace("-", " ")
-            return (city, state) if city else (None, None)
-    state = parts[-1]
-    city = " ".join(p.replace("-", " ") for p in parts[:-1])
-    return (city, state)
+    m = _STATE_SUFFIX_RE.search(slug)
+    if m:
+        city = slug[:m.start()].replace("-", " ")
+        state = m.group(1).replace("-", " ")
+        return (city, state) if city else (None, None)
+    city_s, _, state = slug.rpartition("-")
+    return (city_s.replace("-", " "), state)
+
+
+@functools.lru_cache(maxsize=50000)
+def _state_for_zip5(zip5):
+    """Look a 5-digit zip up in the zipcodes DB once; repeat calls are served from the cache."""
+    try:
+        matches = zipcodes.matching(zip5)
+        if matches:
+            return matches[0].get("state")
+    except Exception:
+        pass
+    return None
 
 
 def get_state_from_zip(zip_code):
@@ -73,13 +99,7 @@ def get_state_from_zip(zip_code):
     if "-" in zip_str:
         zip_str = zip_str.split("-")[0]
     if len(zip_str) >= 5 and zip_str[:5].isdigit():
-        try:
-            import zipcodes
-            matches = zipcodes.matching(zip_str[:5])
-            if matches:
-                return matches[0].get("state")
-        except Exception:
-            pass
+        return _state_for_zip5(zip_str[:5])
     return None
 
 
@@ -91,7 +111,7 @@ def parse_city_state_from_address(address, zip_code=None):
     """
     if not address or not address.strip():
         return (None, None)
-    parts = [p.strip() for p in address.split(",") if p.strip()]
+    parts = [p for p in _COMMA_SPLIT.split(address.strip()) if p]
     if not parts:
         return (None, None)
 
@@ -100,10 +120,10 @@ def parse_city_state_from_address(address, zip_code=None):
 
     # Last part: might be "MA", "CA" (state) or "Boston" (city) or "94301" (zip)
     if len(parts) >= 2:
-        last = parts[-1].upper()
+        last = parts[-1]
         # Two letters = likely state abbreviation
-        if len(last) == 2 and last in US_STATE_ABBREVS:
-            state = last
+        if last in _STATE_ABBREVS_ANY_CASE:
+            state = last.upper()
             city = parts[-2] if len(parts) >= 2 else None
         # Five digits = zip in address
         elif len(last) == 5 and last.isdigit():
@@ -126,6 +146,11 @@ def parse_city_state_from_address(address, zip_code=None):
     return (city, state)
 
 
+def normalize_address(address, zip_code):
+    """Return the display form of an address (see ensure_state_in_address), never None."""
+    return ensure_state_in_address(address or "", zip_code or "") or address or ""
+
+
 def ensure_state_in_address(address, zip_code):
     """
     If address doesn't end with a state abbreviation, append it (from zip) when possible.
@@ -134,20 +159,19 @@ def ensure_state_in_address(address, zip_code):
     if not address or not address.strip():
         return address
     addr = address.strip()
-    parts = [p.strip() for p in addr.split(",") if p.strip()]
+    parts = [p for p in _COMMA_SPLIT.split(addr) if p]
     if not parts:
         return address
 
-    last = parts[-1].upper()
+    last = parts[-1]
     # Already has state abbreviation at end
-    if len(last) == 2 and last in US_STATE_ABBREVS:
+    if last in _STATE_ABBREVS_ANY_CASE:
         return address
     # Last part is 5-digit zip in address - insert state before it if we have zip
     if len(last) == 5 and last.isdigit():
         state = get_state_from_zip(zip_code or last)
         if state and len(parts) >= 2:
-            second_last = parts[-2].upper()
-            if len(second_last) == 2 and second_last in US_STATE_ABBREVS:
+            if parts[-2] in _STATE_ABBREVS_ANY_CASE:
                 return address
             # "123 Main St, Boston, 02101" -> "123 Main St, Boston, MA"
             return "{}, {}".format(addr.rsplit(",", 1)[0].strip(), state)
@@ -1,27 +1,172 @@
-import json
+import bisect
+import itertools
+import math
 import time
-import urllib.parse
-import urllib.request
 
-from django.core.serializers import serialize
-from django.http import JsonResponse
+import numpy as np
+import orjson
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 # from django.contrib.gis.geoip2 import GeoIP2
-from geopy.geocoders import Nominatim
-from geopy.distance import distance
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # optional; nearest-marker queries fall back to a bounding-box scan
+    cKDTree = None
+from ._kernels import EARTH_DIAMETER_MILES, haversine_miles
+from .geocode import geocode_place
 from .models import Bathroom
 from .utils import (
-    ensure_state_in_address,
     city_slug,
     parse_city_slug,
     parse_city_state_from_address,
 )
 
-# Cache for place search: {("city", "ST"): (lat, lon)}, refreshed every 5 min
+# Cache for place search: ({"City, ST": (lat, lon)}, {slug: (lat, lon)}, search index),
+# refreshed every 5 min
 _places_cache = None
 _places_cache_time = 0
 _PLACES_CACHE_TTL = 300
 
+# Cache for distance queries: (lats, lons, rows, tree) ordered by id, refreshed every 5 min
+_bathrooms_cache = None
+_bathrooms_cache_time = 0
+_BATHROOMS_CACHE_TTL = 300
+# Nearest-marker queries first look only inside a box this far around the center
+_PREFILTER_RADIUS_MILES = 200.0
+# Marker responses larger than this are streamed, _MARKERS_STREAM_CHUNK rows at a time
+_MARKERS_STREAM_OVER = 5000
+_MARKERS_STREAM_CHUNK = 1000
+
+
+def _load_bathrooms():
+    """Return float64 lat/lon arrays for all located bathrooms, matching
+    render-ready dicts, and a KD-tree over the points (None without scipy)."""
+    global _bathrooms_cache, _bathrooms_cache_time
+    now = time.time()
+    if _bathrooms_cache is not None and (now - _bathrooms_cache_time) < _BATHROOMS_CACHE_TTL:
+        return _bathrooms_cache
+    qs = (
+        Bathroom.objects.exclude(latitude__isnull=True).exclude(longitude__isnull=True)
+        .order_by("id")
+        # Have the database hand back floats rather than Decimals
+        .annotate(lat_f=Cast("latitude", FloatField()), lon_f=Cast("longitude", FloatField()))
+        .values_list(
+            "name", "address_normalized", "address", "zip",
+            "lat_f", "lon_f", "hours", "remarks",
+        )
+        # Stream rows so the queryset's result cache doesn't hold the table too
+        .iterator(chunk_size=1000)
+    )
+    rows = []
+    for name, address_normalized, address, zip_code, lat, lon, hours, remarks in qs:
+        rows.append({
+            "name": name or "",
+            "address": address_normalized or address or "",
+            "zip": zip_code or "",
+            "latitude": lat,
+            "longitude": lon,
+            "hours": hours or "",
+            "remarks": remarks or "",
+        })
+    lats = np.array([r["latitude"] for r in rows], dtype=np.float64)
+    lons = np.array([r["longitude"] for r in rows], dtype=np.float64)
+    tree = cKDTree(_unit_vectors(lats, lons)) if cKDTree is not None and rows else None
+    _bathrooms_cache = (lats, lons, rows, tree)
+    _bathrooms_cache_time = now
+    return _bathrooms_cache
+
+
+@receiver(post_save, sender=Bathroom)
+@receiver(post_delete, sender=Bathroom)
+def _invalidate_bathrooms_cache(sender, **kwargs):
+    """Drop the distance cache when a bathroom changes (bulk writes wait for the TTL)."""
+    global _bathrooms_cache
+    _bathrooms_cache = None
+
+
+def _distances_miles(lat, lon, lats, lons):
+    """Haversine distance in miles from (lat, lon) to every point in lats/lons."""
+    return haversine_miles(lats, lons, lat, lon)
+
+
+def _unit_vectors(lats, lons):
+    """Points on the unit sphere; chord length there grows with great-circle distance."""
+    lats_r, lons_r = np.radians(lats), np.radians(lons)
+    cos_lats = np.cos(lats_r)
+    return np.column_stack((cos_lats * np.cos(lons_r), cos_lats * np.sin(lons_r), np.sin(lats_r)))
+
+
+def _nearest(miles, limit=None):
+    """Indices into miles from nearest to farthest (ties in id order), at most limit of them."""
+    if limit is not None and limit < len(miles):
+        if limit <= 0:
+            return np.arange(0)
+        # Everything up to the limit-th smallest distance, including all ties with it
+        kth = miles[np.argpartition(miles, limit - 1)[limit - 1]]
+        idx = np.flatnonzero(miles <= kth)
+    else:
+        idx = np.arange(len(miles))
+    # idx is ascending, so a stable sort by distance leaves ties in id order
+    return idx[np.argsort(miles[idx], kind="stable")][:limit]
+
+
+def _nearest_to(lat, lon, lats, lons, limit, tree=None):
+    """Return (indices, miles) of the up-to-limit points nearest (lat, lon), nearest first.
+
+    With a KD-tree the candidates are the points no farther than the limit-th nearest
+    one. Otherwise only points inside a bounding box of _PREFILTER_RADIUS_MILES around
+    the center are measured; if fewer than limit of them fall within that radius the
+    answer may lie outside the box, so every point is measured instead.
+    """
+    if tree is not None and math.isfinite(lat) and math.isfinite(lon):
+        center = _unit_vectors(lat, lon)[0]
+        chords, _ = tree.query(center, k=[min(limit, tree.n)])
+        # A hair of slack keeps points tied with the limit-th one in the running
+        reach = chords[0] * (1 + 1e-9) + 1e-12
+        idx = np.sort(np.asarray(tree.query_ball_point(center, reach), dtype=np.intp))
+        miles = _distances_miles(lat, lon, lats[idx], lons[idx])
+    else:
+        radius = _PREFILTER_RADIUS_MILES / (EARTH_DIAMETER_MILES / 2)  # radians
+        dlat = math.degrees(radius)
+        box = np.abs(lats - lat) <= dlat
+        if abs(lat) + dlat < 90:
+            # Widest longitude span of the circle at this latitude (no shortcut over a pole)
+            dlon = math.degrees(math.asin(math.sin(radius) / math.cos(math.radians(lat))))
+            lon_diff = np.abs(lons - lon)
+            box &= np.minimum(lon_diff, 360 - lon_diff) <= dlon
+        idx = np.flatnonzero(box)
+        miles = _distances_miles(lat, lon, lats[idx], lons[idx])
+        if np.count_nonzero(miles <= _PREFILTER_RADIUS_MILES) < limit:
+            idx = np.arange(len(lats))
+            miles = _distances_miles(lat, lon, lats, lons)
+    order = _nearest(miles, limit)
+    return idx[order], miles[order]
+
+
+def _row_to_dict(row, dist_miles=None):
+    """Marker dict for a cached row; rows are shared, so a distance goes on a copy."""
+    if dist_miles is None:
+        return row
+    return dict(row, dist=dist_miles)
+
+
+def _iter_rows_with_distance(center, limit=None):
+    """Yield (miles, row) for the bathrooms nearest center, nearest first (all without a limit)."""
+    lat, lon = center
+    lats, lons, rows, tree = _load_bathrooms()
+    if limit is None:
+        miles = _distances_miles(lat, lon, lats, lons)
+        idx = _nearest(miles)
+        miles = miles[idx]
+    else:
+        idx, miles = _nearest_to(lat, lon, lats, lons, limit, tree)
+    for j, d in zip(idx.tolist(), miles.tolist()):
+        yield d, rows[j]
+
 
 def _build_places_index():
     """Build index of unique (city, state) -> (lat, lon) from bathroom records."""
@@ -29,36 +174,57 @@ def _build_places_index():
     now = time.time()
     if _places_cache is not None and (now - _places_cache_time) < _PLACES_CACHE_TTL:
         return _places_cache
+    # Give each (city, state) an integer code in first-seen order, then sum the
+    # coordinates per code in one vectorized pass
     places = {}
-    for b in Bathroom.objects.exclude(latitude__isnull=True).exclude(longitude__isnull=True):
-        city, state = parse_city_state_from_address(b.address or "", b.zip)
+    codes, lats, lons = [], [], []
+    qs = (
+        Bathroom.objects.exclude(latitude__isnull=True).exclude(longitude__isnull=True)
+        .annotate(lat_f=Cast("latitude", FloatField()), lon_f=Cast("longitude", FloatField()))
+        .values_list("address", "zip", "lat_f", "lon_f")
+        .iterator(chunk_size=1000)
+    )
+    for address, zip_code, lat, lon in qs:
+        city, state = parse_city_state_from_address(address or "", zip_code)
         if not city:
             continue
-        try:
-            lat, lon = float(b.latitude), float(b.longitude)
-        except (ValueError, TypeError):
-            continue
         key = (city.strip(), (state or "").strip())
-        if key not in places:
-            places[key] = [lat, lon, 1]
-        else:
-            places[key][0] += lat
-            places[key][1] += lon
-            places[key][2] += 1
+        codes.append(places.setdefault(key, len(places)))
+        lats.append(lat)
+        lons.append(lon)
+    codes = np.array(codes, dtype=np.intp)
+    counts = np.bincount(codes, minlength=len(places))
+    lat_means = np.bincount(codes, weights=lats, minlength=len(places)) / counts
+    lon_means = np.bincount(codes, weights=lons, minlength=len(places)) / counts
     # Average coords per place; also build slug->(lat,lon) for city param lookup
     result = {}
     slugs = {}
-    for (city, state), (lat_sum, lon_sum, count) in places.items():
+    named = []
+    for (city, state), lat, lon in zip(places, lat_means.tolist(), lon_means.tolist()):
         display = "{}, {}".format(city, state) if state else city
-        lat, lon = lat_sum / count, lon_sum / count
         result[display] = (lat, lon)
+        named.append((display, city, state, lat, lon))
         if state:
             slug = city_slug(city, state)
             if slug:
                 slugs[slug] = (lat, lon)
-    _places_cache = (result, slugs)
+    # Search entries (lower, display, lat, lon, slug) sorted by lowercased name, so the
+    # places starting with a query form one contiguous run; places without a slug of
+    # their own borrow the first slug at the same coordinates.
+    slug_by_coords = {}
+    for slug, coords in slugs.items():
+        slug_by_coords.setdefault(coords, slug)
+    entries = []
+    for display, city, state, lat, lon in named:
+        slug = city_slug(city, state) if state else None
+        if not slug:
+            slug = slug_by_coords.get((lat, lon))
+        entries.append((display.lower(), display, lat, lon, slug))
+    entries.sort(key=lambda e: e[0])
+    search = ([e[0] for e in entries], entries)
+    _places_cache = (result, slugs, search)
     _places_cache_time = now
-    return (result, slugs)
+    return _places_cache
 
 
 def place_search_view(request):
@@ -66,29 +232,22 @@ def place_search_view(request):
     q = (request.GET.get("q") or "").strip().lower()
     if len(q) < 2:
         return JsonResponse({"results": []})
-    places_data = _build_places_index()
-    places = places_data[0] if isinstance(places_data, tuple) else places_data
-    slugs = places_data[1] if isinstance(places_data, tuple) and len(places_data) > 1 else {}
-    results = []
-    for display_name, (lat, lon) in places.items():
-        if q in display_name.lower():
-            slug = None
-            if "," in display_name:
-                city_part, state_part = display_name.rsplit(",", 1)
-                slug = city_slug(city_part.strip(), state_part.strip())
-            if not slug and (lat, lon) in [v for v in slugs.values()]:
-                for s, coords in slugs.items():
-                    if coords == (lat, lon):
-                        slug = s
-                        break
-            results.append({
-                "display_name": display_name,
-                "lat": lat,
-                "lon": lon,
-                "city": slug,
-            })
-    results.sort(key=lambda x: (x["display_name"].lower().startswith(q), x["display_name"].lower()))
-    return JsonResponse({"results": results[:12]})
+    keys, entries = _build_places_index()[2]
+    # Places starting with q sit in entries[lo:hi]
+    lo = bisect.bisect_left(keys, q)
+    hi = bisect.bisect_left(keys, q[:-1] + chr(ord(q[-1]) + 1)) if q[-1] < "\U0010ffff" else len(keys)
+    # Sorted by (doesn't start with q, name): prefix matches first, then other
+    # substring matches; the rest of the list is only scanned if 12 aren't found
+    matches = itertools.chain(
+        itertools.islice(entries, lo, hi),
+        (e for e in itertools.islice(entries, lo) if q in e[0]),
+        (e for e in itertools.islice(entries, hi, None) if q in e[0]),
+    )
+    results = [
+        {"display_name": display_name, "lat": lat, "lon": lon, "city": slug}
+        for _, display_name, lat, lon, slug in itertools.islice(matches, 12)
+    ]
+    return JsonResponse({"results": results})
 
 
 def bathrooms_view(request):
@@ -108,32 +267,16 @@ def bathrooms_view(request):
         else:
             city, state = parse_city_slug(city_param)
             if city and state:
-                geocoder = Nominatim(user_agent="bathroom_map_3")
-                location = geocoder.geocode(city + ", " + state)
+                location = geocode_place(city, state)
                 if location:
-                    latitude, longitude = location.latitude, location.longitude
+                    latitude, longitude = location
     
     if latitude is not None and longitude is not None:
-        center = (latitude, longitude)
         max_markers = 2000
-        ret_ordered = []
-        for marker in Bathroom.objects.all():
-            if marker.latitude is None or marker.longitude is None:
-                continue
-            dist = distance(center, (marker.latitude, marker.longitude))
-            addr = ensure_state_in_address(marker.address or "", marker.zip or "") or marker.address
-            ret_ordered.append({
-                'name': marker.name,
-                'address': addr,
-                'zip': marker.zip,
-                'latitude': float(marker.latitude),
-                'longitude': float(marker.longitude),
-                'hours': marker.hours or '',
-                'remarks': marker.remarks or '',
-                'dist': dist.miles
-            })
-        ret_ordered.sort(key=lambda x: x['dist'])
-        markers = ret_ordered[:max_markers]
+        markers = [
+            _row_to_dict(row, dist)
+            for dist, row in _iter_rows_with_distance((latitude, longitude), max_markers)
+        ]
     else:
         markers = []
 
@@ -151,6 +294,23 @@ def get_client_ip(request):
         ip = request.META.get('REMOTE_ADDR')
     return ip
 
+def _markers_response(markers):
+    """JSON {"markers": markers} encoded with orjson."""
+    if len(markers) <= _MARKERS_STREAM_OVER:
+        body = orjson.dumps({"markers": markers})
+        return HttpResponse(body, content_type="application/json")
+
+    def chunks():
+        yield b'{"markers":['
+        for start in range(0, len(markers), _MARKERS_STREAM_CHUNK):
+            if start:
+                yield b","
+            yield orjson.dumps(markers[start:start + _MARKERS_STREAM_CHUNK])[1:-1]
+        yield b"]}"
+
+    return StreamingHttpResponse(chunks(), content_type="application/json")
+
+
 def markers_json_view(request):
     """Return markers for the map. Supports:
     - lat/lon: return up to 2000 nearest markers to center (for initial load).
@@ -171,30 +331,14 @@ def markers_json_view(request):
         else:
             lat_min, lat_max = min(sw_lat, ne_lat), max(sw_lat, ne_lat)
             lon_min, lon_max = min(sw_lon, ne_lon), max(sw_lon, ne_lon)
-            qs = Bathroom.objects.filter(
-                latitude__gte=lat_min, latitude__lte=lat_max,
-                longitude__gte=lon_min, longitude__lte=lon_max
-            ).exclude(latitude__isnull=True).exclude(longitude__isnull=True)
+            lats, lons, rows, _ = _load_bathrooms()
+            in_bounds = (
+                (lats >= lat_min) & (lats <= lat_max)
+                & (lons >= lon_min) & (lons <= lon_max)
+            )
             max_bounds = 25000  # allow full nationwide dataset when zoomed out
-            ret = []
-            for m in qs[:max_bounds]:
-                try:
-                    mlat, mlon = float(m.latitude), float(m.longitude)
-                except (ValueError, TypeError):
-                    continue
-                if mlat < -90 or mlat > 90 or mlon < -180 or mlon > 180:
-                    continue
-                addr = ensure_state_in_address(m.address or "", m.zip or "") or m.address or ""
-                ret.append({
-                    "name": m.name or "",
-                    "address": addr,
-                    "zip": m.zip or "",
-                    "latitude": mlat,
-                    "longitude": mlon,
-                    "hours": m.hours or "",
-                    "remarks": m.remarks or "",
-                })
-            return JsonResponse({"markers": ret})
+            idx = np.flatnonzero(in_bounds)[:max_bounds].tolist()
+            return _markers_response([_row_to_dict(rows[j]) for j in idx])
 
     # Center-based: return nearest 2000 markers (for initial/zoomed-in load)
     try:
@@ -202,28 +346,10 @@ def markers_json_view(request):
         lon = float(request.GET.get("lon", -71.06))
     except (ValueError, TypeError):
         lat, lon = 42.36, -71.06
-    center = (lat, lon)
     max_markers = 2000
-    ret = []
-    for m in Bathroom.objects.exclude(latitude__isnull=True).exclude(longitude__isnull=True):
-        try:
-            mlat, mlon = float(m.latitude), float(m.longitude)
-        except (ValueError, TypeError):
-            continue
-        if mlat < -90 or mlat > 90 or mlon < -180 or mlon > 180:
-            continue
-        addr = ensure_state_in_address(m.address or "", m.zip or "") or m.address or ""
-        ret.append({
-            "name": m.name or "",
-            "address": addr,
-            "zip": m.zip or "",
-            "latitude": mlat,
-            "longitude": mlon,
-            "hours": m.hours or "",
-            "remarks": m.remarks or "",
-        })
-    ret.sort(key=lambda x: distance(center, (x["latitude"], x["longitude"])).miles)
-    return JsonResponse({"markers": ret[:max_markers]})
+    return _markers_response([
+        _row_to_dict(row) for _, row in _iter_rows_with_distance((lat, lon), max_markers)
+    ])
 
 
 def bathrooms_order_by_distance_view(request):
@@ -235,23 +361,8 @@ def bathrooms_order_by_distance_view(request):
     #     user_lat = user_imprecise_loc['latitude']
     #     user_long = user_imprecise_loc['longitude']
 
-    ret_ordered = []
-    for marker in Bathroom.objects.all():
-        dist = distance((float(user_lat), float(user_long)), (marker.latitude, marker.longitude))
-        addr_display = ensure_state_in_address(marker.address or "", marker.zip or "")
-        marker_dict = {
-            'name': marker.name,
-            'address': addr_display or marker.address,
-            'zip': marker.zip,
-            'latitude': float(marker.latitude),
-            'longitude': float(marker.longitude),
-            'hours': marker.hours,
-            'remarks': marker.remarks,
-            'dist': dist.miles
-        }
-        ret_ordered.append(marker_dict)
-
-    ret_ordered.sort(key=lambda x: x['dist'])
+    center = (float(user_lat), float(user_long))
+    ret_ordered = [_row_to_dict(row, dist) for dist, row in _iter_rows_with_distance(center)]
 
     return render(request, "list.html", {
         'markers': ret_ordered